@@ -1,6 +1,9 @@
 """Polars pipes for the performance management chart."""
 
 import logging
+import re
+from collections.abc import Callable
+from functools import partial
 from typing import TypeVar
 
 import polars as pl
@@ -9,66 +12,219 @@ from polars.exceptions import ComputeError, InvalidOperationError
 
 SomeDataFrame = TypeVar("SomeDataFrame", pl.LazyFrame, pl.DataFrame)
 
+logger = logging.getLogger(__name__)
+
+SEMICIRCLES_TO_DEGREES = 180 / 2**31
+SEMICIRCLE_COLUMNS = r"^.*_(lat|lon).*$"
+
+DATETIME_FORMATS = [
+    "%B %d, %Y, %I:%M %p",  # e.g. "February 22, 2023, 11:56 AM"
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S%.fZ",  # iso format
+    None,  # other iso formats, inferred by polars
+]
+
+# Polars infers far more than ISO 8601 (e.g. day-first "01/02/2023"), so an
+# inferred format is only tried on values that start like an ISO date.
+ISO_8601_PATTERN = r"^\d{4}-?\d{2}-?\d{2}(T|$)"
+
+
+def _to_datetime(col: str, format: str | None) -> pl.Expr:
+    """Parse the column with the format, or let polars infer it if None."""
+    if format is not None:
+        return pl.col(col).str.to_datetime(format=format)
+
+    # A trailing "Z" is dropped to return naive UTC times like the formats
+    # above. Other offsets make the inference fail, so that such columns are
+    # left untouched rather than silently shifted.
+    return pl.col(col).str.strip_suffix("Z").str.to_datetime()
+
+
+def _datetime_pattern(format: str | None) -> str | None:
+    """Return the pattern that values must match to try the format."""
+    return ISO_8601_PATTERN if format is None else None
+
+
+def _to_numeric(col: str, dtype: DataTypeClass) -> pl.Expr:
+    """Parse the column as a number, ignoring thousands separators."""
+    return pl.col(col).str.replace_all(",", "").cast(dtype)
+
+
+# Promotions of string columns in the order in which they are tried. Each
+# entry holds a regex that all sampled values must match before the promotion
+# is tried (or None), and builds the promotion expression for a column name.
+UTF8_PROMOTIONS: list[tuple[str | None, Callable[[str], pl.Expr]]] = [
+    *(
+        (_datetime_pattern(format), partial(_to_datetime, format=format))
+        for format in DATETIME_FORMATS
+    ),
+    (None, partial(_to_numeric, dtype=pl.Int64)),
+    (None, partial(_to_numeric, dtype=pl.Float64)),
+]
+
 
 class PolarsPiper:
     @staticmethod
-    def magic(_df: pl.DataFrame) -> pl.DataFrame:
+    def magic(_df: SomeDataFrame, rechunk: bool = False) -> SomeDataFrame:
         """
         Apply a series of transformations to the DataFrame.
 
+        The transformations are planned from a single walk over the schema
+        and run as one query. Planning reads the input to detect all-null
+        columns and to sample string columns. A LazyFrame is collected and
+        its result returned as a LazyFrame, so the transformations are not
+        deferred.
+
         Parameters
         ----------
-        _df : pl.DataFrame
+        _df : SomeDataFrame
             The input DataFrame.
+        rechunk : bool, optional
+            Whether to rechunk the result into contiguous memory. This pays
+            off when the result is fed into heavy numeric computations.
 
         Returns
         -------
-        pl.DataFrame
+        SomeDataFrame
             The transformed DataFrame.
 
         """
-        return (
-            _df.pipe(PolarsPiper.drop_rows_that_are_all_null)
-            .pipe(PolarsPiper.drop_columns_that_are_all_null)
-            .pipe(PolarsPiper.utf8_promotion)
-            .pipe(PolarsPiper.semicircle_to_degrees)
+        exprs, kept = PolarsPiper._plan(_df)
+        lf = _df.lazy().pipe(PolarsPiper._drop_all_null_rows_and_cols, kept)
+        try:
+            # Lazy frames only fail on collect, so they are collected here
+            # too rather than validated and then run a second time.
+            result = lf.with_columns(exprs).collect()
+        except (InvalidOperationError, ComputeError):
+            # Some promotion failed beyond the sampled values, fall back to
+            # running the transformations one after the other.
+            result = (
+                lf.collect()
+                .pipe(PolarsPiper.utf8_promotion)
+                .pipe(PolarsPiper.semicircle_to_degrees)
+            )
+
+        if rechunk:
+            result = result.rechunk()
+        return result.lazy() if isinstance(_df, pl.LazyFrame) else result
+
+    @staticmethod
+    def _plan(_df: SomeDataFrame) -> tuple[list[pl.Expr], list[str]]:
+        """
+        Plan the transformations of `magic` from a single walk over the schema.
+
+        Parameters
+        ----------
+        _df : SomeDataFrame
+            The input DataFrame.
+
+        Returns
+        -------
+        tuple[list[pl.Expr], list[str]]
+            The expressions to apply and the columns that are not all null.
+
+        """
+        schema = PolarsPiper._schema(_df)
+        kept = PolarsPiper._columns_not_all_null(_df)
+        samples = PolarsPiper._utf8_samples(
+            _df, [col for col in kept if schema[col] == pl.Utf8]
         )
+        promotions = PolarsPiper._utf8_promotion_exprs(samples)
+
+        exprs = []
+        for col in kept:
+            expr = promotions.get(col)
+            if re.match(SEMICIRCLE_COLUMNS, col):
+                expr = pl.col(col) if expr is None else expr
+                expr = expr * SEMICIRCLES_TO_DEGREES
+            if expr is not None:
+                exprs.append(expr)
+
+        return exprs, kept
 
     @staticmethod
-    def drop_rows_that_are_all_null(_df: pl.DataFrame) -> pl.DataFrame:
+    def drop_rows_that_are_all_null(_df: SomeDataFrame) -> SomeDataFrame:
         """
         Drop rows that are all null.
 
         Parameters
         ----------
-        _df : pl.DataFrame
+        _df : SomeDataFrame
             The input DataFrame.
 
         Returns
         -------
-        pl.DataFrame
+        SomeDataFrame
             The DataFrame with rows that are all null removed.
 
         """
         return _df.filter(~pl.all_horizontal(pl.all().is_null()))
 
     @staticmethod
-    def drop_columns_that_are_all_null(_df: pl.DataFrame) -> pl.DataFrame:
+    def drop_columns_that_are_all_null(_df: SomeDataFrame) -> SomeDataFrame:
         """
         Drop columns that are all null.
 
         Parameters
         ----------
-        _df : pl.DataFrame
+        _df : SomeDataFrame
             The input DataFrame.
 
         Returns
         -------
-        pl.DataFrame
+        SomeDataFrame
             The DataFrame with columns that are all null removed.
 
         """
-        return _df[[s.name for s in _df if not (s.null_count() == _df.height)]]
+        return _df.select(PolarsPiper._columns_not_all_null(_df))
+
+    @staticmethod
+    def _schema(_df: SomeDataFrame) -> pl.Schema:
+        """Return the schema, only resolving the query plan of LazyFrames."""
+        if isinstance(_df, pl.DataFrame):
+            return _df.schema
+        return _df.collect_schema()
+
+    @staticmethod
+    def _columns_not_all_null(_df: SomeDataFrame) -> list[str]:
+        """Return the names of the columns that hold at least one value."""
+        is_all_null = _df.select(pl.all().null_count() == pl.len())
+        if isinstance(is_all_null, pl.LazyFrame):
+            is_all_null = is_all_null.collect()
+
+        return [s.name for s in is_all_null if not s.item()]
+
+    @staticmethod
+    def _drop_all_null_rows_and_cols(
+        _df: SomeDataFrame, kept: list[str] | None = None
+    ) -> SomeDataFrame:
+        """
+        Drop columns and rows that are all null in a single pass.
+
+        Columns that are all null never decide whether a row is all null, so
+        the row filter only needs to look at the columns that are kept.
+
+        Parameters
+        ----------
+        _df : SomeDataFrame
+            The input DataFrame.
+        kept : list of str, optional
+            The columns that are not all null. If None, they are computed.
+
+        Returns
+        -------
+        SomeDataFrame
+            The DataFrame with all-null columns and rows removed.
+
+        """
+        if kept is None:
+            kept = PolarsPiper._columns_not_all_null(_df)
+        if not kept:
+            return _df.select(kept)
+
+        return _df.select(kept).filter(
+            ~pl.all_horizontal(pl.col(kept).is_null())
+        )
 
     @staticmethod
     def semicircle_to_degrees(_df: SomeDataFrame) -> SomeDataFrame:
@@ -86,9 +242,9 @@ class PolarsPiper:
             The DataFrame with semicircles converted to degrees.
 
         """
-        cols = [col for col in _df.columns if "_lat" in col or "_lon" in col]
-        logging.info(f"Converting semicircles to degrees for columns: {cols}")
-        return _df.with_columns(pl.col(cols) * 180 / 2**31)
+        return _df.with_columns(
+            pl.col(SEMICIRCLE_COLUMNS) * SEMICIRCLES_TO_DEGREES
+        )
 
     @staticmethod
     def convert_times_to_datetime(
@@ -111,13 +267,19 @@ class PolarsPiper:
 
         """
         cols = cols or ["timestamp", "start_time", "created_at", "updated_at"]
-        cols = [col for col in cols if col in _df.columns]
-        logging.info(f"Converting times to datetime for columns: {cols}")
+        names = set(PolarsPiper._schema(_df).names())
+        cols = [col for col in cols if col in names]
+        if not cols:
+            return _df
+
+        logger.info("Converting times to datetime for columns: %s", cols)
         return _df.with_columns(pl.col(cols).str.to_datetime())
 
     @staticmethod
     def cast_time_in_zone_string_to_list_of_float(
-        _df: SomeDataFrame, cols: list[str] | None = None
+        _df: SomeDataFrame,
+        cols: list[str] | None = None,
+        widths: dict[str, int] | None = None,
     ) -> SomeDataFrame:
         """
         Cast the time in zone string to a list of floats.
@@ -128,17 +290,39 @@ class PolarsPiper:
             The input DataFrame.
         cols : list of str, optional
             The columns to convert. If None, defaults to common time zone columns.
+        widths : dict of str to int, optional
+            The number of zones per column. Columns listed here are cast to
+            fixed-width arrays instead of lists, which are stored without
+            per-row offsets. Every row must then have exactly that many zones.
 
         Returns
         -------
         SomeDataFrame
             The DataFrame with time in zone strings converted to lists of floats.
 
+        Raises
+        ------
+        ComputeError
+            If a column listed in `widths` has a row with a different number
+            of zones. For a LazyFrame, this is raised on collect.
+
         """
         cols = cols or ["time_in_hr_zone_sec", "time_in_pwr_zone_sec"]
-        cols = [col for col in cols if col in _df.columns]
+        names = set(PolarsPiper._schema(_df).names())
+        cols = [col for col in cols if col in names]
+        if not cols:
+            return _df
+
+        widths = widths or {}
+        dtypes = {
+            col: pl.Array(pl.Float64, widths[col])
+            if col in widths
+            else pl.List(pl.Float64)
+            for col in cols
+        }
         return _df.with_columns(
-            pl.col(cols).str.split("|").cast(pl.List(pl.Float64))
+            pl.col(col).str.split("|").cast(dtype)
+            for col, dtype in dtypes.items()
         )
 
     @staticmethod
@@ -157,22 +341,123 @@ class PolarsPiper:
             The DataFrame with promoted datatypes.
 
         """
-        for col in _df.columns:
-            if _df.collect_schema()[col] != pl.Utf8:
-                continue
+        schema = PolarsPiper._schema(_df)
+        cols = [col for col, dtype in schema.items() if dtype == pl.Utf8]
+        if not cols:
+            return _df
 
-            _df, _success = PolarsPiper.try_to_datetime(_df, col)
-            if _success:
-                continue
+        # Decide on a promotion per column from a small sample of non-null
+        # values, then apply all promotions in a single pass.
+        samples = PolarsPiper._utf8_samples(_df, cols)
+        promotions = PolarsPiper._utf8_promotion_exprs(samples)
 
-            _df, _success = PolarsPiper.try_to_numeric(_df, col, pl.Int64)
-            if _success:
-                continue
+        try:
+            if isinstance(_df, pl.LazyFrame):
+                # Lazy frames only fail on collect, so validate eagerly.
+                _df.select(promotions.values()).collect()
+            return _df.with_columns(promotions.values())
+        except InvalidOperationError:
+            pass
+        except ComputeError:
+            pass
 
-            _df, _success = PolarsPiper.try_to_numeric(_df, col, pl.Float64)
+        # Some promotion failed beyond the sample. Columns for which the
+        # sample rejected every promotion cannot be promoted at all, so only
+        # the others are promoted again, one by one on their full contents.
+        for col in promotions:
+            _df = PolarsPiper._promote_column(_df, col, samples[col])
 
         return _df
 
+    @staticmethod
+    def _promote_column(
+        _df: SomeDataFrame, col: str, sample: pl.DataFrame
+    ) -> SomeDataFrame:
+        """Apply the first promotion that the sample and full column accept."""
+        for pattern, promotion in UTF8_PROMOTIONS:
+            expr = promotion(col)
+            if not PolarsPiper._sample_accepts(sample, col, pattern, expr):
+                continue
+
+            try:
+                if isinstance(_df, pl.LazyFrame):
+                    # Lazy frames only fail on collect, so validate eagerly.
+                    _df.select(expr).collect()
+                return _df.with_columns(expr)
+            except InvalidOperationError:
+                pass
+            except ComputeError:
+                pass
+        return _df
+
+    @staticmethod
+    def _utf8_samples(
+        _df: SomeDataFrame, cols: list[str]
+    ) -> dict[str, pl.DataFrame]:
+        """Collect a small sample of non-null values for each column."""
+        if not cols:
+            return {}
+
+        samples = (
+            _df.lazy()
+            .select(pl.col(cols).drop_nulls().head(16).implode())
+            .collect()
+        )
+        return {col: samples.get_column(col)[0].to_frame(col) for col in cols}
+
+    @staticmethod
+    def _utf8_promotion_exprs(
+        samples: dict[str, pl.DataFrame],
+    ) -> dict[str, pl.Expr]:
+        """
+        Find a promotion for each column from its sample of non-null values.
+
+        Parameters
+        ----------
+        samples : dict[str, pl.DataFrame]
+            The sample of each string column, see `_utf8_samples`.
+
+        Returns
+        -------
+        dict[str, pl.Expr]
+            The promotion of every column for which one was found.
+
+        """
+        exprs = {}
+        for col, sample in samples.items():
+            expr = PolarsPiper._utf8_promotion_expr(sample, col)
+            if expr is not None:
+                exprs[col] = expr
+
+        return exprs
+
+    @staticmethod
+    def _utf8_promotion_expr(sample: pl.DataFrame, col: str) -> pl.Expr | None:
+        """Return the first promotion of the column that the sample accepts."""
+        for pattern, promotion in UTF8_PROMOTIONS:
+            expr = promotion(col)
+            if PolarsPiper._sample_accepts(sample, col, pattern, expr):
+                return expr
+        return None
+
+    @staticmethod
+    def _sample_accepts(
+        sample: pl.DataFrame, col: str, pattern: str | None, expr: pl.Expr
+    ) -> bool:
+        """Return whether the sample matches the pattern and the expression."""
+        if pattern is not None and not (
+            sample.select(pl.col(col).str.contains(pattern).all()).item()
+        ):
+            return False
+
+        try:
+            sample.select(expr)
+            return True
+        except InvalidOperationError:
+            return False
+        except ComputeError:
+            return False
+
     @staticmethod
     def try_convert_dtypes_to_float_if_possible(
         _df: SomeDataFrame,
@@ -182,22 +467,51 @@ class PolarsPiper:
 
         Parameters
         ----------
-        _df : pl.DataFrame
+        _df : SomeDataFrame
             The input DataFrame.
 
         Returns
         -------
-        pl.DataFrame
+        SomeDataFrame
             The DataFrame with data types converted to float where possible.
 
         """
-        for col in _df.columns:
-            try:
-                _df = _df.with_columns(pl.col(col).cast(pl.Float64))
-            except InvalidOperationError:
-                pass
+        # Nested, binary and categorical columns cannot be cast to floats.
+        schema = PolarsPiper._schema(_df)
+        cols = [
+            col
+            for col, dtype in schema.items()
+            if dtype.is_numeric()
+            or dtype.is_temporal()
+            or dtype in (pl.Utf8, pl.Boolean, pl.Null)
+        ]
+        if not cols:
+            return _df
+
+        # Cast once under temporary names. A non-strict cast turns values that
+        # cannot be cast into nulls, so a cast is kept exactly if it does not
+        # add any nulls.
+        suffix = "__float"
+        while any(col + suffix in schema for col in cols):
+            suffix += "_"
+        cast = _df.with_columns(
+            pl.col(cols).cast(pl.Float64, strict=False).name.suffix(suffix)
+        )
 
-        return _df
+        adds_nulls = cast.select(
+            (
+                pl.col(col + suffix).null_count() != pl.col(col).null_count()
+            ).alias(col)
+            for col in cols
+        )
+        if isinstance(adds_nulls, pl.LazyFrame):
+            adds_nulls = adds_nulls.collect()
+
+        castable = {s.name for s in adds_nulls if not s.item()}
+        return cast.select(
+            pl.col(col + suffix).alias(col) if col in castable else pl.col(col)
+            for col in schema.names()
+        )
 
     @staticmethod
     def try_to_datetime(
@@ -219,15 +533,21 @@ class PolarsPiper:
             The DataFrame and a boolean indicating success.
 
         """
-        for format in [
-            "%B %d, %Y, %I:%M %p",  # e.g. "February 22, 2023, 11:56 AM"
-            "%Y-%m-%d %H:%M:%S",
-            "%Y-%m-%dT%H:%M:%S%.fZ",  # iso format
-        ]:
+        # Probe each format on a single non-null value first, so that
+        # formats which clearly do not match never touch the full column.
+        sample = _df.lazy().select(pl.col(col).drop_nulls().head(1)).collect()
+        for format in DATETIME_FORMATS:
+            expr = _to_datetime(col, format)
+            if not PolarsPiper._sample_accepts(
+                sample, col, _datetime_pattern(format), expr
+            ):
+                continue
+
             try:
-                _df = _df.with_columns(
-                    pl.col(col).str.to_datetime(format=format)
-                )
+                if isinstance(_df, pl.LazyFrame):
+                    # Lazy frames only fail on collect, so validate eagerly.
+                    _df.select(expr).collect()
+                _df = _df.with_columns(expr)
                 return _df, True
             except InvalidOperationError:
                 pass
@@ -257,10 +577,33 @@ class PolarsPiper:
             The DataFrame and a boolean indicating success.
 
         """
+        # Rule out columns that are clearly not numeric on a small sample
+        # before casting the full column.
+        sample = _df.lazy().select(pl.col(col).drop_nulls().head(64)).collect()
+        expr = _to_numeric(col, dtype)
         try:
-            _df = _df.with_columns(
-                pl.col(col).str.replace_all(",", "").cast(dtype)
-            )
+            sample.select(expr)
+        except InvalidOperationError:
+            return _df, False
+        except ComputeError:
+            return _df, False
+
+        # Most numeric columns contain no thousands separators at all, in
+        # which case the string replacement can be skipped.
+        has_comma = (
+            _df.lazy()
+            .select(pl.col(col).str.contains(",", literal=True).any())
+            .collect()
+            .item()
+        )
+        if not has_comma:
+            expr = pl.col(col).cast(dtype)
+
+        try:
+            if isinstance(_df, pl.LazyFrame):
+                # Lazy frames only fail on collect, so validate eagerly.
+                _df.select(expr).collect()
+            _df = _df.with_columns(expr)
             return _df, True
         except InvalidOperationError:
             return _df, False
@@ -286,9 +629,5 @@ class PolarsPiper:
         else:
             null_count = _df.null_count()
 
-        return _df.select(
-            null_count.transpose(include_header=True)
-            .sort("column_0")
-            .get_column("column")
-            .to_list()
-        )
+        counts = {s.name: s.item() for s in null_count}
+        return _df.select(sorted(counts, key=counts.__getitem__))
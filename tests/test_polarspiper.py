@@ -2,12 +2,15 @@
 
 import polars as pl
 import pytest
+from polars.exceptions import ComputeError
 
+import polarspiper.polarspiper as polarspiper_module
 from polarspiper import (
     cast_time_in_zone_string_to_list_of_float,
     convert_times_to_datetime,
     drop_columns_that_are_all_null,
     drop_rows_that_are_all_null,
+    magic,
     semicircle_to_degrees,
     sort_columns_by_null_count,
     try_convert_dtypes_to_float_if_possible,
@@ -122,3 +125,164 @@ def test_sort_columns_by_null_count_lazyframe(get_df) -> None:
     null_counts = get_df.null_count().to_dict(as_series=False)
     sorted_columns = sorted(null_counts, key=null_counts.get)
     assert result.columns == sorted_columns
+
+
+def test_magic(get_df) -> None:
+    result = magic(get_df)
+    assert isinstance(result, pl.DataFrame)
+    assert result.height == get_df.height - 1
+    assert "all_null_col" not in result.columns
+    assert result["timestamp"].dtype == pl.Datetime
+    assert result["floatstr"].dtype == pl.Float64
+    assert result["d_lat"][0] == pytest.approx(1000000000 / 2**31 * 180)
+
+
+def test_try_to_datetime_failure(get_df) -> None:
+    df, success = try_to_datetime(get_df, "floatstr")
+    assert not success
+    assert df["floatstr"].dtype == pl.Utf8
+
+
+def test_drop_columns_that_are_all_null_lazyframe(get_df) -> None:
+    result = drop_columns_that_are_all_null(get_df.lazy()).collect()
+    assert "all_null_col" not in result.columns
+    assert result.width == get_df.width - 1
+
+
+def test_try_convert_dtypes_to_float_if_possible_skips_strings(
+    get_df,
+) -> None:
+    result = try_convert_dtypes_to_float_if_possible(get_df)
+    assert result["floatstr"].dtype == pl.Float64
+    assert result["timestamp"].dtype == pl.Utf8
+    assert result["time_in_hr_zone_sec"].dtype == pl.Utf8
+
+
+def test_utf8_promotion_lazyframe(get_df) -> None:
+    result = utf8_promotion(get_df.lazy()).collect()
+    assert result["timestamp"].dtype == pl.Datetime
+    assert result["floatstr"].dtype == pl.Float64
+    assert result["time_in_hr_zone_sec"].dtype == pl.Utf8
+
+
+def test_magic_falls_back_when_sample_is_misleading() -> None:
+    df = pl.DataFrame({"t": ["2023-01-01 00:00:00"] * 20 + ["not a date"]})
+    result = magic(df)
+    assert result["t"].dtype == pl.Utf8
+
+
+def test_magic_lazyframe_falls_back_when_sample_is_misleading() -> None:
+    df = pl.DataFrame({"t": ["2023-01-01 00:00:00"] * 20 + ["not a date"]})
+    result = magic(df.lazy()).collect()
+    assert result["t"].dtype == pl.Utf8
+    assert result.equals(magic(df))
+
+
+def test_magic_rechunk(get_df) -> None:
+    df = pl.concat([get_df, get_df], rechunk=False)
+    assert all(s.n_chunks() > 1 for s in df)
+    assert all(s.n_chunks() > 1 for s in magic(df, rechunk=False))
+    assert all(s.n_chunks() == 1 for s in magic(df, rechunk=True))
+
+
+@pytest.mark.parametrize(
+    "value", ["2023-01-01T10:00:00.123Z", "20190418T224555.555Z"]
+)
+def test_try_to_datetime_iso8601(value) -> None:
+    df, success = try_to_datetime(pl.DataFrame({"iso": [value]}), "iso")
+    assert success
+    assert df["iso"].dtype == pl.Datetime(time_zone=None)
+
+
+@pytest.mark.parametrize("value", ["01/02/2023", "31-12-2023", "2023/01/02"])
+def test_utf8_promotion_keeps_non_iso_dates(value) -> None:
+    df = pl.DataFrame({"d": [value]})
+    assert utf8_promotion(df)["d"].to_list() == [value]
+    assert magic(df)["d"].to_list() == [value]
+    _, success = try_to_datetime(df, "d")
+    assert not success
+
+
+def test_try_to_datetime_keeps_offsets() -> None:
+    df = pl.DataFrame({"iso": ["2023-01-01T10:00:00+02:00"]})
+    df, success = try_to_datetime(df, "iso")
+    assert not success
+    assert df["iso"].to_list() == ["2023-01-01T10:00:00+02:00"]
+
+
+def test_try_to_numeric_failure(get_df) -> None:
+    df, success = try_to_numeric(get_df, "time_in_hr_zone_sec", pl.Float64)
+    assert not success
+    assert df["time_in_hr_zone_sec"].dtype == pl.Utf8
+
+
+def test_try_to_numeric_with_thousands_separator() -> None:
+    df = pl.DataFrame({"n": ["1,000", "2"]})
+    df, success = try_to_numeric(df, "n", pl.Int64)
+    assert success
+    assert df["n"].to_list() == [1000, 2]
+
+
+def test_convert_times_to_datetime_without_matching_columns(get_df) -> None:
+    result = convert_times_to_datetime(get_df, cols=["missing"])
+    assert result is get_df
+
+
+def test_cast_time_in_zone_string_to_list_of_float_with_widths(get_df) -> None:
+    result = cast_time_in_zone_string_to_list_of_float(
+        get_df, widths={"time_in_hr_zone_sec": 3}
+    )
+    assert result["time_in_hr_zone_sec"].dtype == pl.Array(pl.Float64, 3)
+    assert result["time_in_hr_zone_sec"][0].to_list() == [1.0, 2.0, 3.0]
+
+
+def test_magic_lazyframe(get_df) -> None:
+    result = magic(get_df.lazy())
+    assert isinstance(result, pl.LazyFrame)
+    assert result.collect().equals(magic(get_df))
+
+
+def test_try_convert_dtypes_to_float_if_possible_keeps_lossy_columns() -> None:
+    df = pl.DataFrame({"ok": ["1.5", None], "lossy": ["1.5", "x"]})
+    result = try_convert_dtypes_to_float_if_possible(df)
+    assert result["ok"].dtype == pl.Float64
+    assert result["lossy"].dtype == pl.Utf8
+
+
+def test_utf8_promotion_falls_back_to_next_promotion() -> None:
+    df = pl.DataFrame({"n": ["1"] * 20 + ["1.5"]})
+    for result in [utf8_promotion(df), utf8_promotion(df.lazy()).collect()]:
+        assert result["n"].dtype == pl.Float64
+        assert result["n"][-1] == 1.5
+
+
+def test_utf8_promotion_fallback_probes_the_sample(monkeypatch) -> None:
+    lengths = []
+
+    def fail(s: pl.Series) -> pl.Series:
+        lengths.append(len(s))
+        raise ComputeError("not promotable")
+
+    monkeypatch.setattr(
+        polarspiper_module,
+        "UTF8_PROMOTIONS",
+        [
+            (None, lambda col: pl.col(col).map_batches(fail)),
+            *polarspiper_module.UTF8_PROMOTIONS,
+        ],
+    )
+    df = pl.DataFrame({"n": ["1"] * 20 + ["1.5"], "s": ["a"] * 21})
+    result = utf8_promotion(df)
+    assert result["n"].dtype == pl.Float64
+    assert result["s"].dtype == pl.Utf8
+    # The failing promotion is only ever tried on the samples.
+    assert lengths and max(lengths) < df.height
+
+
+def test_cast_time_in_zone_string_to_list_of_float_with_wrong_width(
+    get_df,
+) -> None:
+    with pytest.raises(ComputeError):
+        cast_time_in_zone_string_to_list_of_float(
+            get_df, widths={"time_in_hr_zone_sec": 5}
+        )